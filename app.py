@@ -3,8 +3,17 @@ import ee
 import geemap.foliumap as geemap
 import folium
 
-# Initialize Earth Engine
-ee.Initialize(project='lake-dashboard-464415')
+# Initialize Earth Engine (once per server process)
+@st.cache_resource
+def init_earth_engine(project_id):
+    ee.Initialize(project=project_id)
+    return True
+
+try:
+    init_earth_engine('lake-dashboard-464415')
+except ee.EEException as e:
+    st.error(f"Earth Engine initialization failed: {e}")
+    st.stop()
 
 # Sidebar title
 st.sidebar.title("LakeHealth Dashboard")
@@ -37,12 +46,6 @@ lake = ee.Geometry.Polygon([[  # Bellandur Lake sample
     [77.6392446351248,12.921051012051585]
 ]])
 
-# Load Sentinel-2 image collection
-collection = ee.ImageCollection('COPERNICUS/S2') \
-    .filterBounds(lake) \
-    .filterDate(f"{start_year}-01-01", f"{end_year}-12-31") \
-    .filter(ee.Filter.lt('CLOUDY_PIXEL_PERCENTAGE', 10))
-
 # Compute FAI and MCI
 def add_fai_mci(image):
     red = image.select('B4')
@@ -68,16 +71,28 @@ def add_fai_mci(image):
 
     return image.addBands(fai).addBands(mci)
 
-# Apply and compute mean of both indices
-with_indices = collection.map(add_fai_mci)
-mean_image = with_indices.select(['FAI', 'MCI']).mean()
-
-# Reduce region mean value
-fai_mean = mean_image.select('FAI').reduceRegion(
-    ee.Reducer.mean(), lake, scale=10, maxPixels=1e9).get('FAI')
-
-mci_mean = mean_image.select('MCI').reduceRegion(
-    ee.Reducer.mean(), lake, scale=10, maxPixels=1e9).get('MCI')
+# Load Sentinel-2 image collection, average the bands and compute both indices
+@st.cache_resource(show_spinner=False)
+def build_mean_image(start_year, end_year):
+    collection = ee.ImageCollection('COPERNICUS/S2') \
+        .filterBounds(lake) \
+        .filterDate(f"{start_year}-01-01", f"{end_year}-12-31") \
+        .filter(ee.Filter.lt('CLOUDY_PIXEL_PERCENTAGE', 10))
+    # FAI and MCI are linear in the bands, so indices of the mean == mean of the indices
+    raw_mean = collection.select(['B4', 'B5', 'B6', 'B8', 'B11']).mean()
+    return add_fai_mci(raw_mean).select(['FAI', 'MCI'])
+
+mean_image = build_mean_image(start_year, end_year)
+
+# Reduce region mean values (both bands in one reduction, at 20 m; the map stays at 10 m)
+METRICS_SCALE = 20
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def get_mean_values(start_year, end_year):
+    means = build_mean_image(start_year, end_year).reduceRegion(
+        reducer=ee.Reducer.mean(), geometry=lake, scale=METRICS_SCALE, maxPixels=1e9,
+        tileScale=4, bestEffort=True)
+    return means.getInfo()
 
 # Visual parameters
 fai_vis = {'min': -0.1, 'max': 0.1, 'palette': ['white', 'green', 'blue']}
@@ -101,8 +116,9 @@ with col2:
     st.markdown("*Maximum Chlorophyll Index*")
 
 # Show individual mean values
-fai_val = fai_mean.getInfo()
-mci_val = mci_mean.getInfo()
+mean_vals = get_mean_values(start_year, end_year)
+fai_val = mean_vals['FAI']
+mci_val = mean_vals['MCI']
 st.subheader("📊 Algal Bloom Detection")
 st.markdown(f"**FAI Mean:** {fai_val:.4f}")
 st.markdown(f"**MCI Mean:** {mci_val:.4f}")
@@ -262,10 +278,14 @@ else:
 #     maxPixels=1e9
 # ).get('MNDWI_Diff')
 
-# # Show Area Info
+# # Show Area Info (both areas fetched in one request, formatted client-side)
+# areas = ee.Dictionary({
+#     'gain': ee.Number(area_gain).divide(1e4),
+#     'loss': ee.Number(area_loss).divide(1e4)
+# }).getInfo()
 # st.sidebar.markdown("---")
-# st.sidebar.markdown(f"### 📉 Water Loss: **{ee.Number(area_loss).divide(1e4).format('%.2f').getInfo()} ha**")
-# st.sidebar.markdown(f"### 📈 Water Gain: **{ee.Number(area_gain).divide(1e4).format('%.2f').getInfo()} ha**")
+# st.sidebar.markdown(f"### 📉 Water Loss: **{areas['loss']:.2f} ha**")
+# st.sidebar.markdown(f"### 📈 Water Gain: **{areas['gain']:.2f} ha**")
 
 # # Visualize Water Change Map
 # st.subheader("🔍 Water Loss/Gain Areas")
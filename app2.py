@@ -1,45 +1,83 @@
 import streamlit as st
+import streamlit.components.v1 as components
 import ee
 import geemap.foliumap as geemap
+import folium
 import json
+import hashlib
+import os
+import tempfile
+import time
 
 # ------------------------
 # 1. EARTH ENGINE INITIALIZATION
 # ------------------------
-def init_earth_engine(project_id: str):
-    """Authenticate and initialize Earth Engine with the given GCP project."""
+@st.cache_resource
+def init_earth_engine(project_id: str) -> bool:
+    """Authenticate and initialize Earth Engine once per server process."""
     ee.Initialize(project=project_id)
+    return True
 
 # ------------------------
 # 2. AREA OF INTEREST
 # ------------------------
+DEFAULT_LAKE_COORDS = [
+    [77.6392446351248, 12.921051012051585],
+    [77.63899787189543, 12.920078493132383],
+    [77.63889435291664, 12.919004787930328],
+    [77.63891849279777, 12.918905443959652],
+    [77.63897481918708, 12.918868843539448],
+    [77.64090064525978, 12.918105462124162],
+    [77.64099720478431, 12.918168205890122],
+    [77.64158729076759, 12.918732899074577],
+    [77.6439254160206,  12.921726115590571],
+    [77.64401392891808, 12.921745722734912],
+    [77.64406891420289, 12.92177317273437 ],
+    [77.64409573629304, 12.921830687009194],
+    [77.64408836311765, 12.921905261527495],
+    [77.64500031418271, 12.92281503075012 ],
+    [77.64506468719907, 12.92293528735337 ],
+    [77.64503786510892, 12.923029401176393],
+    [77.64451751656003, 12.923834595767756],
+    [77.64441559261746, 12.923892109567786],
+    [77.64130959457822, 12.923060772442854],
+    [77.64042983002133, 12.923322199510041],
+    [77.64032254166074, 12.923311742432603],
+    [77.6392446351248,  12.921051012051585]
+]
+
+
+@st.cache_resource
 def get_default_geometry() -> ee.Geometry:
-    """Return the default lake boundary polygon (Bellandur Lake sample)."""
-    coords = [
-        [77.6392446351248, 12.921051012051585],
-        [77.63899787189543, 12.920078493132383],
-        [77.63889435291664, 12.919004787930328],
-        [77.63891849279777, 12.918905443959652],
-        [77.63897481918708, 12.918868843539448],
-        [77.64090064525978, 12.918105462124162],
-        [77.64099720478431, 12.918168205890122],
-        [77.64158729076759, 12.918732899074577],
-        [77.6439254160206,  12.921726115590571],
-        [77.64401392891808, 12.921745722734912],
-        [77.64406891420289, 12.92177317273437 ],
-        [77.64409573629304, 12.921830687009194],
-        [77.64408836311765, 12.921905261527495],
-        [77.64500031418271, 12.92281503075012 ],
-        [77.64506468719907, 12.92293528735337 ],
-        [77.64503786510892, 12.923029401176393],
-        [77.64451751656003, 12.923834595767756],
-        [77.64441559261746, 12.923892109567786],
-        [77.64130959457822, 12.923060772442854],
-        [77.64042983002133, 12.923322199510041],
-        [77.64032254166074, 12.923311742432603],
-        [77.6392446351248,  12.921051012051585]
-    ]
-    return ee.Geometry.Polygon([coords])
+    """Return the default lake boundary polygon (Bellandur Lake sample), built once."""
+    return ee.Geometry.Polygon([DEFAULT_LAKE_COORDS])
+
+
+def _geom_hash(aoi: ee.Geometry) -> bytes:
+    """Hash an AOI by its GeoJSON, serialized client-side to avoid a getInfo round trip."""
+    try:
+        geojson = aoi.toGeoJSON()
+    except ee.EEException:
+        # Computed geometries have no local coordinates
+        geojson = aoi.getInfo()
+    return hashlib.blake2b(json.dumps(geojson, sort_keys=True).encode(), digest_size=16).digest()
+
+
+GEOMETRY_HASH_FUNCS = {ee.Geometry: _geom_hash}
+
+
+@st.cache_resource(max_entries=8, show_spinner=False)
+def parse_geojson_geometry(geojson_str: str) -> ee.Geometry:
+    """Parse a GeoJSON Feature(Collection) or Geometry string into an EE Geometry (memoized)."""
+    geojson = json.loads(geojson_str)
+    # If Feature, extract geometry
+    if 'features' in geojson:
+        geom = geojson['features'][0]['geometry']
+    elif 'geometry' in geojson:
+        geom = geojson['geometry']
+    else:
+        geom = geojson
+    return ee.Geometry(geom)
 
 
 def get_custom_geometry() -> ee.Geometry:
@@ -51,15 +89,7 @@ def get_custom_geometry() -> ee.Geometry:
             'Paste Polygon GeoJSON (Feature or Geometry):', height=200)
         if geojson_str:
             try:
-                geojson = json.loads(geojson_str)
-                # If Feature, extract geometry
-                if 'features' in geojson:
-                    geom = geojson['features'][0]['geometry']
-                elif 'geometry' in geojson:
-                    geom = geojson['geometry']
-                else:
-                    geom = geojson
-                return ee.Geometry(geom)
+                return parse_geojson_geometry(geojson_str)
             except Exception as e:
                 st.sidebar.error(f'Invalid GeoJSON: {e}')
                 return get_default_geometry()
@@ -72,20 +102,58 @@ def get_custom_geometry() -> ee.Geometry:
 # ------------------------
 # 3. IMAGE COLLECTION LOADING
 # ------------------------
+def mask_scl(image: ee.Image) -> ee.Image:
+    """Keep only clear pixels (vegetation, bare, water, unclassified, snow) per the SCL band."""
+    scl = image.select('SCL')
+    mask = scl.eq(4).Or(scl.eq(5)).Or(scl.eq(6)).Or(scl.eq(7)).Or(scl.eq(11))
+    return image.updateMask(mask)
+
+
+def mask_cloud_probability(image: ee.Image) -> ee.Image:
+    """Mask pixels whose joined S2 cloud probability is 30% or higher."""
+    cloud_prob = ee.Image(image.get('cloud_mask')).select('probability')
+    return image.updateMask(cloud_prob.lt(30))
+
+
+# S2_SR_HARMONIZED (L2A) only covers this region from late 2018 onwards
+FIRST_SR_YEAR = 2019
+
+
 def load_sentinel_collection(aoi: ee.Geometry, start_year: int, end_year: int) -> ee.ImageCollection:
-    """Load and filter Sentinel-2 ImageCollection for given years and AOI."""
+    """Load, filter, cloud-mask and clip Sentinel-2 surface reflectance to the AOI."""
     start_date = ee.Date.fromYMD(start_year, 1, 1)
     end_date = ee.Date.fromYMD(end_year, 12, 31)
-    return (
-        ee.ImageCollection('COPERNICUS/S2')
+    s2 = (
+        ee.ImageCollection('COPERNICUS/S2_SR_HARMONIZED')
         .filterBounds(aoi)
         .filterDate(start_date, end_date)
-        .filter(ee.Filter.lt('CLOUDY_PIXEL_PERCENTAGE', 10))
+        .filter(ee.Filter.lt('CLOUDY_PIXEL_PERCENTAGE', 60))
+    )
+    clouds = (
+        ee.ImageCollection('COPERNICUS/S2_CLOUD_PROBABILITY')
+        .filterBounds(aoi)
+        .filterDate(start_date, end_date)
+    )
+    # Attach each scene's cloud probability image as the 'cloud_mask' property
+    joined = ee.Join.saveFirst('cloud_mask').apply(
+        primary=s2,
+        secondary=clouds,
+        condition=ee.Filter.equals(leftField='system:index', rightField='system:index')
+    )
+    return (
+        ee.ImageCollection(joined)
+        .map(mask_cloud_probability)
+        .map(mask_scl)
+        .map(lambda img: img.clip(aoi))
     )
 
 # ------------------------
 # 4. INDEX CALCULATIONS
 # ------------------------
+INDEX_SOURCE_BANDS = ['B4', 'B5', 'B6', 'B8', 'B11']
+INDEX_BANDS = ['FAI', 'MCI', 'Turbidity']
+
+
 def normalize(image: ee.Image) -> ee.Image:
     """Normalize reflectance bands (0-10000) to 0-1."""
     return image.divide(10000)
@@ -93,57 +161,175 @@ def normalize(image: ee.Image) -> ee.Image:
 
 def add_fai_mci_turbidity(image: ee.Image) -> ee.Image:
     """Compute FAI, MCI, and Turbidity proxies and add as bands."""
-    img = normalize(image)
-    # FAI
-    red, nir, swir = img.select('B4'), img.select('B8'), img.select('B11')
-    RED_WL, NIR_WL, SWIR_WL = 665, 842, 1610
-    baseline = red.add(swir.subtract(red).multiply(NIR_WL-RED_WL).divide(SWIR_WL-RED_WL))
-    fai = nir.subtract(baseline).rename('FAI')
+    # Only normalize the bands the indices use, and evaluate each index as one expression
+    img = normalize(image.select(INDEX_SOURCE_BANDS))
+    bands = {
+        'b4': img.select('B4'), 'b5': img.select('B5'), 'b6': img.select('B6'),
+        'b8': img.select('B8'), 'b11': img.select('B11')
+    }
+    # FAI (red/NIR/SWIR wavelengths 665/842/1610 nm)
+    fai = img.expression('b8 - (b4 + (b11 - b4)*((842.0-665.0)/(1610.0-665.0)))', bands).rename('FAI')
     # MCI
-    mci = img.expression(
-        'b5 - b4 - (b6 - b4)*((705-665)/(740-665))',
-        {'b4': img.select('B4'), 'b5': img.select('B5'), 'b6': img.select('B6')}
-    ).rename('MCI')
+    mci = img.expression('b5 - b4 - (b6 - b4)*((705.0-665.0)/(740.0-665.0))', bands).rename('MCI')
     # Turbidity
-    turb = img.select('B11').divide(img.select('B4')).rename('Turbidity')
+    turb = img.expression('b11 / b4', bands).rename('Turbidity')
     return image.addBands([fai, mci, turb])
 
 # ------------------------
 # 5. AGGREGATION & METRICS
 # ------------------------
 def compute_mean_image(collection: ee.ImageCollection) -> ee.Image:
-    """Select index bands and compute mean composite."""
-    return collection.select(['FAI', 'MCI', 'Turbidity']).mean()
-
-
-def compute_mean_value(img: ee.Image, band: str, aoi: ee.Geometry) -> float:
-    """Get the mean value of a band over the AOI."""
-    return float(
-        img.select(band)
-           .reduceRegion(
-               reducer=ee.Reducer.mean(),
-               geometry=aoi,
-               scale=10,
-               maxPixels=1e9
-           )
-           .get(band)
-           .getInfo()
-    )
+    """Composite the source bands (median) and compute the indices once on the composite."""
+    composite = collection.select(INDEX_SOURCE_BANDS).median()
+    indices = add_fai_mci_turbidity(composite).select(INDEX_BANDS)
+    # An empty collection has a band-less median; fall back to a fully masked image
+    # so reductions yield None and map tiles stay blank instead of raising
+    empty = ee.Image.constant([0, 0, 0]).rename(INDEX_BANDS).updateMask(0)
+    return ee.Image(ee.Algorithms.If(collection.size().gt(0), indices, empty))
+
+
+@st.cache_resource(show_spinner=False, hash_funcs=GEOMETRY_HASH_FUNCS)
+def build_mean_image(aoi: ee.Geometry, start_year: int, end_year: int) -> ee.Image:
+    """Build the index composite for an AOI and year range once and reuse the handle."""
+    return compute_mean_image(load_sentinel_collection(aoi, start_year, end_year))
+
+
+# Metric reductions run at 20 m: the lake-wide means converge well before 10 m,
+# and the pixel count drops 4x. Map layers still render at native resolution.
+METRICS_SCALE = 20
+
+
+def compute_mean_values(mean_img: ee.Image, bands: list, aoi: ee.Geometry) -> dict:
+    """Get the mean value of each band over the AOI in one round trip."""
+    img = mean_img.select(bands)
+    return img.reduceRegion(
+        reducer=ee.Reducer.mean().forEachBand(img),
+        geometry=aoi,
+        scale=METRICS_SCALE,
+        maxPixels=1e9,
+        bestEffort=True,
+        tileScale=4
+    ).getInfo()
+
+
+@st.cache_data(ttl=3600, show_spinner=False, hash_funcs=GEOMETRY_HASH_FUNCS)
+def get_mean_values(aoi: ee.Geometry, start_year: int, end_year: int, bands: tuple) -> dict:
+    """Cached band means for an AOI and year range."""
+    if not bands:
+        return {}
+    mean_img = build_mean_image(aoi, start_year, end_year)
+    return compute_mean_values(mean_img, list(bands), aoi)
 
 # ------------------------
 # 6. LAYER DISPLAY FUNCTION
 # ------------------------
+# EE map IDs are server-side resources that expire, so every cache holding a
+# tile URL is bounded. A URL can sit in get_tile_url, then in the rendered-map
+# cache, then in a session's results (re-rendered after MAP_TTL), so the oldest
+# URL a page can show is TILE_URL_TTL + 2 * MAP_TTL (5 h).
+MAP_TTL = 3600
+TILE_URL_TTL = 3 * MAP_TTL
+
+
+@st.cache_resource(ttl=TILE_URL_TTL, max_entries=64, show_spinner=False)
+def get_tile_url(image_json: str, vis_json: str) -> str:
+    """Request an EE map ID once per (image, vis params) and return its tile URL template."""
+    image = ee.Image(ee.deserializer.fromJSON(image_json))
+    map_id = image.getMapId(json.loads(vis_json))
+    return map_id['tile_fetcher'].url_format
+
+
 def display_layers(map_obj: geemap.Map, mean_img: ee.Image, layers: list, vis_params: dict, aoi: ee.Geometry):
     """Add specified layers to the map with their visualization parameters."""
     for key in layers:
-        map_obj.addLayer(
-            mean_img.select(key).clip(aoi),
-            vis_params[key],
-            f"{key} Index",
+        url = get_tile_url(mean_img.select(key).serialize(), json.dumps(vis_params[key], sort_keys=True))
+        folium.TileLayer(
+            tiles=url,
+            attr='Google Earth Engine',
+            name=f"{key} Index",
+            overlay=True,
             opacity=0.6
-        )
+        ).add_to(map_obj)
     map_obj.addLayer(aoi, {'color':'red'}, 'Boundary')
-    map_obj.to_streamlit(height=600)
+
+
+MAP_DIR = os.path.join(tempfile.gettempdir(), 'lake_maps')
+MAP_HEIGHT = 600
+MAP_CACHE_ENTRIES = 16  # bounds both the HTML cache and the map files on disk
+
+# Loader page for the single map component. It speaks a minimal subset of
+# Streamlit's internal custom-component protocol (the postMessage calls that
+# streamlit-component-lib makes): announce readiness, fix the frame height and
+# load the map file named in each render event. Re-check it on Streamlit upgrades.
+MAP_LOADER_HTML = """<!DOCTYPE html>
+<html><body style="margin:0">
+<iframe id="map" style="border:0;width:100%%;height:%(height)dpx"></iframe>
+<script>
+  function sendToStreamlit(type, data) {
+    window.parent.postMessage(Object.assign({isStreamlitMessage: true, type: type}, data), '*');
+  }
+  window.addEventListener('message', function (event) {
+    if (event.data.type !== 'streamlit:render') return;
+    var frame = document.getElementById('map');
+    var src = 'maps/' + event.data.args.map;
+    if (frame.getAttribute('src') !== src) frame.setAttribute('src', src);
+  });
+  sendToStreamlit('streamlit:componentReady', {apiVersion: 1});
+  sendToStreamlit('streamlit:setFrameHeight', {height: %(height)d});
+</script>
+</body></html>
+"""
+
+
+@st.cache_data(ttl=MAP_TTL, max_entries=MAP_CACHE_ENTRIES, show_spinner=False,
+               hash_funcs=GEOMETRY_HASH_FUNCS)
+def render_map_html(aoi: ee.Geometry, layers: tuple, start_year: int, end_year: int, vis_params: dict) -> str:
+    """Build the layer map once per AOI, layers and years and return its HTML."""
+    mean_img = build_mean_image(aoi, start_year, end_year)
+    map_obj = geemap.Map(center=[12.922,77.633], zoom=15, google_map='HYBRID')
+    display_layers(map_obj, mean_img, list(layers), vis_params, aoi)
+    # get_root().render() skips the layer control that to_streamlit() used to add
+    map_obj.add_layer_control()
+    return map_obj.get_root().render()
+
+
+@st.cache_resource
+def get_map_component():
+    """Write the loader page and register the one map component for the process."""
+    os.makedirs(os.path.join(MAP_DIR, 'maps'), exist_ok=True)
+    with open(os.path.join(MAP_DIR, 'index.html'), 'w', encoding='utf-8') as f:
+        f.write(MAP_LOADER_HTML % {'height': MAP_HEIGHT})
+    return components.declare_component('lake_map', path=MAP_DIR)
+
+
+def save_map(html: str) -> str:
+    """Write map HTML under MAP_DIR/maps, pruning old maps, and return its file name."""
+    maps_dir = os.path.join(MAP_DIR, 'maps')
+    name = hashlib.blake2b(html.encode('utf-8'), digest_size=8).hexdigest() + '.html'
+    path = os.path.join(maps_dir, name)
+    try:
+        os.utime(path)  # mark as recently used so pruning keeps it
+        return name
+    except FileNotFoundError:
+        pass  # new map, or pruned since it was last shown
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(html)
+    try:
+        old_maps = sorted(
+            (os.path.join(maps_dir, n) for n in os.listdir(maps_dir)),
+            key=os.path.getmtime, reverse=True
+        )[MAP_CACHE_ENTRIES:]
+        for old in old_maps:
+            os.remove(old)
+    except OSError:
+        pass  # another session pruned concurrently; the next write retries
+    return name
+
+
+def show_map(html: str):
+    """Embed a map; the browser loads it over HTTP instead of the app websocket."""
+    lake_map = get_map_component()
+    lake_map(map=save_map(html), key='lake_map', default=None)
 
 # ------------------------
 # 7. LEGEND DESCRIPTION
@@ -160,17 +346,23 @@ def describe_legends(vis_params: dict, thresholds: dict):
 # ------------------------
 # 8. UI COMPONENTS
 # ------------------------
-def render_sidebar_metrics(selected_layers, mean_img, aoi, thresholds):
+def render_sidebar_metrics(selected_layers, values, thresholds):
     st.sidebar.markdown('## 🧪 Water Quality Summary')
-    alerts = []
+    alerts, missing = [], []
     for key in selected_layers:
-        val = compute_mean_value(mean_img, key, aoi)
+        if values.get(key) is None:
+            missing.append(key)
+            continue
+        val = float(values[key])
         st.sidebar.markdown(f'- **{key} Mean:** {val:.3f}')
         if val > thresholds[key]:
             alerts.append(key)
+    if missing:
+        st.sidebar.warning('No cloud-free imagery for ' + ', '.join(missing)
+                           + ' over this AOI and period; try a wider or later year range.')
     if alerts:
         st.sidebar.error('⚠️ Alert: ' + ', '.join(alerts) + ' above safe levels!')
-    else:
+    elif not missing:
         st.sidebar.success('✅ All metrics within safe limits')
 
 # ------------------------
@@ -178,35 +370,54 @@ def render_sidebar_metrics(selected_layers, mean_img, aoi, thresholds):
 # ------------------------
 def main():
     st.title('🌊 LakeHealth Dashboard')
-    init_earth_engine('lake-dashboard-464415')
-    start_year = st.sidebar.slider('Start Year', 2016, 2024, 2020)
-    end_year   = st.sidebar.slider('End Year', start_year, 2024, 2024)
-    # AOI choice
-    aoi = get_custom_geometry()
-    # Layer toggles
-    st.sidebar.markdown('## Select Layers')
+    try:
+        init_earth_engine('lake-dashboard-464415')
+    except ee.EEException as e:
+        # Failures are not cached, so the next rerun retries initialization
+        st.error(f'Earth Engine initialization failed: {e}')
+        st.stop()
+    # Controls are batched in a form so the app only recomputes on "Update"
     layers = ['FAI', 'MCI', 'Turbidity']
-    selected = [l for l in layers if st.sidebar.checkbox(l, True)]
-    # Load & process imagery
-    collection = load_sentinel_collection(aoi, start_year, end_year)
-    with_idx = collection.map(add_fai_mci_turbidity)
-    mean_img = compute_mean_image(with_idx)
+    with st.sidebar.form('controls'):
+        # One range slider: a dependent End slider would only see the last submitted start
+        start_year, end_year = st.slider('Years', 2016, 2024, (2020, 2024))
+        # Layer toggles
+        st.markdown('## Select Layers')
+        selected = [l for l in layers if st.checkbox(l, True)]
+        submitted = st.form_submit_button('Update')
+    if start_year < FIRST_SR_YEAR:
+        st.sidebar.info(f'Surface-reflectance imagery starts in late {FIRST_SR_YEAR - 1}; '
+                        f'years before {FIRST_SR_YEAR} contribute no scenes.')
+    # AOI choice (applied on the next Update)
+    aoi = get_custom_geometry()
     # Thresholds
     thresholds = {'FAI':0.05, 'MCI':0.02, 'Turbidity':1.8}
-    # Render outputs
-    render_sidebar_metrics(selected, mean_img, aoi, thresholds)
     vis_params = {
         'FAI':       {'min': -0.1,  'max': 0.1,  'palette': ['white','green','blue']},
         'MCI':       {'min': -0.05, 'max': 0.2,  'palette': ['white','orange','red']},
         'Turbidity': {'min': 0.0,   'max': 3.0,  'palette': ['blue','yellow','red']}
     }
-    display_layers(
-        geemap.Map(center=[12.922,77.633], zoom=15, google_map='HYBRID'),
-        mean_img,
-        selected,
-        vis_params,
-        aoi
-    )
+    # Run the EE pipeline only on submit (or first load) and keep the last results
+    if submitted or 'results' not in st.session_state:
+        st.session_state['results'] = {
+            'selected': selected,
+            'aoi_hash': _geom_hash(aoi),
+            # Fetch every thresholded band at once so toggling layers reuses the cached dict
+            'values': get_mean_values(aoi, start_year, end_year, tuple(thresholds)),
+            'map_args': (aoi, tuple(selected), start_year, end_year),
+            'map_html': render_map_html(aoi, tuple(selected), start_year, end_year, vis_params),
+            'rendered_at': time.time()
+        }
+    results = st.session_state['results']
+    # Re-render a map kept open past MAP_TTL so its EE tile URLs don't go stale
+    if time.time() - results['rendered_at'] > MAP_TTL:
+        results['map_html'] = render_map_html(*results['map_args'], vis_params)
+        results['rendered_at'] = time.time()
+    if results['aoi_hash'] != _geom_hash(aoi):
+        st.info('AOI changed — press Update to refresh the map and metrics.')
+    # Render outputs
+    render_sidebar_metrics(results['selected'], results['values'], thresholds)
+    show_map(results['map_html'])
     describe_legends(vis_params, thresholds)
 
 if __name__ == '__main__':
@@ -1,25 +1,42 @@
 import streamlit as st
+import streamlit.components.v1 as components
 import ee
 import geemap.foliumap as geemap
+import folium
 import json
+import hashlib
+import os
+import tempfile
+import time
 import requests
+from concurrent.futures import ThreadPoolExecutor
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
 # ------------------------
 # 1. EARTH ENGINE INITIALIZATION
 # ------------------------
-def init_earth_engine(project_id: str):
-    """Authenticate and initialize Earth Engine with the given GCP project."""
+@st.cache_resource
+def init_earth_engine(project_id: str) -> bool:
+    """Authenticate and initialize Earth Engine once per server process."""
     ee.Initialize(project=project_id)
+    return True
 
 # ------------------------
 # 2. POLYGON API INTERACTIONS
 # ------------------------
 API_BASE = 'https://api.agromonitoring.com/agro/1.0'
 
+@st.cache_resource
+def get_http_session() -> requests.Session:
+    """Shared HTTP session so API calls reuse the TCP/TLS connection."""
+    return requests.Session()
+
+
+@st.cache_data(ttl=600, show_spinner=False)
 def list_polygons_api(appid: str) -> list:
-    """Fetch list of polygons from AgroMonitoring API."""
+    """Fetch list of polygons from AgroMonitoring API (cached for 10 minutes)."""
     params = {'appid': appid}
-    resp = requests.get(f"{API_BASE}/polygons", params=params)
+    resp = get_http_session().get(f"{API_BASE}/polygons", params=params)
     resp.raise_for_status()
     return resp.json()
 
@@ -27,38 +44,61 @@ def list_polygons_api(appid: str) -> list:
 # 3. AREA OF INTEREST SELECTION
 # ------------------------
 
+DEFAULT_LAKE_COORDS = [
+    [77.6392446351248,12.921051012051585],
+    [77.63899787189543,12.920078493132383],
+    [77.63889435291664,12.919004787930328],
+    [77.63891849279777,12.918905443959652],
+    [77.63897481918708,12.918868843539448],
+    [77.64090064525978,12.918105462124162],
+    [77.64099720478431,12.918168205890122],
+    [77.64158729076759,12.918732899074577],
+    [77.6439254160206,12.921726115590571],
+    [77.64401392891808,12.921745722734912],
+    [77.64406891420289,12.92177317273437 ],
+    [77.64409573629304,12.921830687009194],
+    [77.64408836311765,12.921905261527495],
+    [77.64500031418271,12.92281503075012 ],
+    [77.64506468719907,12.92293528735337 ],
+    [77.64503786510892,12.923029401176393],
+    [77.64451751656003,12.923834595767756],
+    [77.64441559261746,12.923892109567786],
+    [77.64130959457822,12.923060772442854],
+    [77.64042983002133,12.923322199510041],
+    [77.64032254166074,12.923311742432603],
+    [77.6392446351248,12.921051012051585]
+]
+
+
+@st.cache_resource
 def get_default_geometry() -> ee.Geometry:
     """Return the default lake boundary polygon."""
-    coords = [
-        [77.6392446351248,12.921051012051585],
-        [77.63899787189543,12.920078493132383],
-        [77.63889435291664,12.919004787930328],
-        [77.63891849279777,12.918905443959652],
-        [77.63897481918708,12.918868843539448],
-        [77.64090064525978,12.918105462124162],
-        [77.64099720478431,12.918168205890122],
-        [77.64158729076759,12.918732899074577],
-        [77.6439254160206,12.921726115590571],
-        [77.64401392891808,12.921745722734912],
-        [77.64406891420289,12.92177317273437 ],
-        [77.64409573629304,12.921830687009194],
-        [77.64408836311765,12.921905261527495],
-        [77.64500031418271,12.92281503075012 ],
-        [77.64506468719907,12.92293528735337 ],
-        [77.64503786510892,12.923029401176393],
-        [77.64451751656003,12.923834595767756],
-        [77.64441559261746,12.923892109567786],
-        [77.64130959457822,12.923060772442854],
-        [77.64042983002133,12.923322199510041],
-        [77.64032254166074,12.923311742432603],
-        [77.6392446351248,12.921051012051585]
-    ]
-    return ee.Geometry.Polygon([coords])
-
-
-def get_polygon_from_api(appid: str) -> ee.Geometry:
-    """Let user select an existing polygon from API and return its EE geometry."""
-    polygons = list_polygons_api(appid)
+    return ee.Geometry.Polygon([DEFAULT_LAKE_COORDS])
+
+
+def _geom_hash(aoi: ee.Geometry) -> bytes:
+    """Cache hash of an AOI from its local GeoJSON (no getInfo unless computed)."""
+    try:
+        gj = aoi.toGeoJSON()
+    except ee.EEException:
+        gj = aoi.getInfo()
+    return hashlib.blake2b(json.dumps(gj,sort_keys=True).encode(),digest_size=16).digest()
+
+
+GEOMETRY_HASH_FUNCS = {ee.Geometry: _geom_hash}
+
+
+@st.cache_resource(max_entries=8, show_spinner=False)
+def parse_geojson_geometry(geojson_str: str) -> ee.Geometry:
+    """Parse pasted GeoJSON (Feature or Geometry) into an EE geometry, memoized by string."""
+    gj = json.loads(geojson_str)
+    geom = (gj.get('features')[0]['geometry']
+            if 'features' in gj else gj.get('geometry', gj))
+    return ee.Geometry(geom)
+
+
+def get_polygon_from_api(polygons: list) -> ee.Geometry:
+    """Let user select an existing polygon from the API list and return its EE geometry."""
     names = [p['name'] + ' (' + p['id'] + ')' for p in polygons]
     choice = st.sidebar.selectbox('Select Saved Polygon', ['--None--'] + names)
     if choice != '--None--':
@@ -68,7 +108,7 @@ def get_polygon_from_api(appid: str) -> ee.Geometry:
     return None
 
 
-def get_custom_geometry(appid: str) -> ee.Geometry:
+def get_custom_geometry(polygons: list) -> ee.Geometry:
     """Prompt user for AOI: default, custom GeoJSON, or saved polygon via API."""
     st.sidebar.markdown('## AOI Selection')
     option = st.sidebar.radio('Boundary Source:', ['Default Lake', 'Custom GeoJSON', 'Saved Polygon'])
@@ -76,15 +116,12 @@ def get_custom_geometry(appid: str) -> ee.Geometry:
         geojson_str = st.sidebar.text_area('Paste Polygon GeoJSON:', height=200)
         if geojson_str:
             try:
-                gj = json.loads(geojson_str)
-                geom = (gj.get('features')[0]['geometry']
-                        if 'features' in gj else gj.get('geometry', gj))
-                return ee.Geometry(geom)
+                return parse_geojson_geometry(geojson_str)
             except:
                 st.sidebar.error('Invalid GeoJSON input.')
                 return get_default_geometry()
-    elif option == 'Saved Polygon' and appid:
-        geom = get_polygon_from_api(appid)
+    elif option == 'Saved Polygon' and polygons is not None:
+        geom = get_polygon_from_api(polygons)
         if geom:
             return geom
         else:
@@ -94,49 +131,186 @@ def get_custom_geometry(appid: str) -> ee.Geometry:
 # ------------------------
 # 4. IMAGE COLLECTION LOADING
 # ------------------------
+def mask_scl(img: ee.Image) -> ee.Image:
+    # keep SCL classes 4,5,6,7,11 (vegetation, bare, water, unclassified, snow)
+    scl = img.select('SCL')
+    mask = scl.eq(4).Or(scl.eq(5)).Or(scl.eq(6)).Or(scl.eq(7)).Or(scl.eq(11))
+    return img.updateMask(mask)
+
+
+def mask_cloud_probability(img: ee.Image) -> ee.Image:
+    # joined S2_CLOUD_PROBABILITY image, keep pixels below 30%
+    prob = ee.Image(img.get('cloud_mask')).select('probability')
+    return img.updateMask(prob.lt(30))
+
+
+FIRST_SR_YEAR = 2019  # S2_SR_HARMONIZED only covers this region from late 2018
+
+
 def load_sentinel_collection(aoi: ee.Geometry, sy: int, ey: int) -> ee.ImageCollection:
     start = ee.Date.fromYMD(sy,1,1)
     end   = ee.Date.fromYMD(ey,12,31)
-    return (
-        ee.ImageCollection('COPERNICUS/S2')
+    s2 = (
+        ee.ImageCollection('COPERNICUS/S2_SR_HARMONIZED')
         .filterBounds(aoi)
         .filterDate(start,end)
-        .filter(ee.Filter.lt('CLOUDY_PIXEL_PERCENTAGE',10))
+        .filter(ee.Filter.lt('CLOUDY_PIXEL_PERCENTAGE',60))
+    )
+    clouds = ee.ImageCollection('COPERNICUS/S2_CLOUD_PROBABILITY').filterBounds(aoi).filterDate(start,end)
+    joined = ee.Join.saveFirst('cloud_mask').apply(
+        primary=s2,secondary=clouds,
+        condition=ee.Filter.equals(leftField='system:index',rightField='system:index'))
+    return (
+        ee.ImageCollection(joined)
+        .map(mask_cloud_probability)
+        .map(mask_scl)
+        .map(lambda img: img.clip(aoi))
     )
 
 # ------------------------
 # 5. INDEX CALCULATIONS & AGGREGATION
 # ------------------------
+INDEX_SOURCE_BANDS = ['B4','B5','B6','B8','B11']
+INDEX_BANDS = ['FAI','MCI','Turbidity']
+
+
 def normalize(img: ee.Image) -> ee.Image:
     return img.divide(10000)
 
 
 def add_fai_mci_turbidity(img: ee.Image) -> ee.Image:
-    norm = normalize(img)
-    red,nir,swir = norm.select('B4'),norm.select('B8'),norm.select('B11')
-    base = red.add(swir.subtract(red).multiply(842-665).divide(1610-665))
-    fai = nir.subtract(base).rename('FAI')
-    mci = norm.expression('b5-b4-(b6-b4)*((705-665)/(740-665))',
-                           {'b4':norm.select('B4'),'b5':norm.select('B5'),'b6':norm.select('B6')}).rename('MCI')
-    turb = norm.select('B11').divide(norm.select('B4')).rename('Turbidity')
+    # normalize only the bands used, one expression per index
+    norm = normalize(img.select(INDEX_SOURCE_BANDS))
+    b = {'b4':norm.select('B4'),'b5':norm.select('B5'),'b6':norm.select('B6'),
+         'b8':norm.select('B8'),'b11':norm.select('B11')}
+    fai = norm.expression('b8-(b4+(b11-b4)*((842.0-665.0)/(1610.0-665.0)))',b).rename('FAI')
+    mci = norm.expression('b5-b4-(b6-b4)*((705.0-665.0)/(740.0-665.0))',b).rename('MCI')
+    turb = norm.expression('b11/b4',b).rename('Turbidity')
     return img.addBands([fai,mci,turb])
 
 
 def compute_mean_image(col: ee.ImageCollection) -> ee.Image:
-    return col.select(['FAI','MCI','Turbidity']).mean()
+    # composite raw bands first, then a single pass of index math on the composite
+    composite = col.select(INDEX_SOURCE_BANDS).median()
+    indices = add_fai_mci_turbidity(composite).select(INDEX_BANDS)
+    # empty collection -> band-less median; use a fully masked image so means are None, not an error
+    empty = ee.Image.constant([0,0,0]).rename(INDEX_BANDS).updateMask(0)
+    return ee.Image(ee.Algorithms.If(col.size().gt(0),indices,empty))
+
 
+@st.cache_resource(show_spinner=False, hash_funcs=GEOMETRY_HASH_FUNCS)
+def build_mean_image(aoi: ee.Geometry, sy: int, ey: int) -> ee.Image:
+    return compute_mean_image(load_sentinel_collection(aoi,sy,ey))
 
-def compute_mean_value(img: ee.Image, band: str, aoi: ee.Geometry) -> float:
-    return float(img.select(band).reduceRegion(ee.Reducer.mean(),aoi,10,1e9).get(band).getInfo())
+
+METRICS_SCALE = 20  # metrics only; map tiles stay at native 10 m
+
+
+def compute_mean_values(mean_img: ee.Image, bands: list, aoi: ee.Geometry) -> dict:
+    img = mean_img.select(bands)
+    return img.reduceRegion(reducer=ee.Reducer.mean().forEachBand(img),geometry=aoi,scale=METRICS_SCALE,
+                            maxPixels=1e9,bestEffort=True,tileScale=4).getInfo()
+
+
+@st.cache_data(ttl=3600, show_spinner=False, hash_funcs=GEOMETRY_HASH_FUNCS)
+def get_mean_values(aoi: ee.Geometry, sy: int, ey: int, bands: tuple) -> dict:
+    if not bands:
+        return {}
+    return compute_mean_values(build_mean_image(aoi,sy,ey),list(bands),aoi)
 
 # ------------------------
 # 6. DISPLAY & UI
 # ------------------------
+# EE map IDs expire server-side. A tile URL can age in get_tile_url, then in the
+# rendered-map cache, then in session results (re-rendered after MAP_TTL):
+# oldest URL shown is TILE_URL_TTL + 2 * MAP_TTL (5 h).
+MAP_TTL = 3600
+TILE_URL_TTL = 3 * MAP_TTL
+
+
+@st.cache_resource(ttl=TILE_URL_TTL, max_entries=64, show_spinner=False)
+def get_tile_url(image_json: str, vis_json: str) -> str:
+    # one getMapId per (image, vis) instead of one per layer per render
+    image = ee.Image(ee.deserializer.fromJSON(image_json))
+    return image.getMapId(json.loads(vis_json))['tile_fetcher'].url_format
+
+
 def display_layers(m, mean_img, layers, vis_params, aoi):
     for k in layers:
-        m.addLayer(mean_img.select(k).clip(aoi),vis_params[k],f"{k} Index",opacity=0.6)
+        url = get_tile_url(mean_img.select(k).serialize(),json.dumps(vis_params[k],sort_keys=True))
+        folium.TileLayer(tiles=url,attr='Google Earth Engine',name=f"{k} Index",overlay=True,opacity=0.6).add_to(m)
     m.addLayer(aoi,{'color':'red'},'Boundary')
-    m.to_streamlit(height=600)
+
+
+MAP_DIR = os.path.join(tempfile.gettempdir(),'lake_maps')
+MAP_HEIGHT = 600
+MAP_CACHE_ENTRIES = 16  # bounds the HTML cache and the map files on disk
+
+# Loader page for the single map component. Uses a minimal subset of Streamlit's
+# internal custom-component protocol (the postMessage calls streamlit-component-lib
+# makes): ready + frame height, then load the map file named in each render event.
+# Re-check on Streamlit upgrades.
+MAP_LOADER_HTML = """<!DOCTYPE html>
+<html><body style="margin:0">
+<iframe id="map" style="border:0;width:100%%;height:%(height)dpx"></iframe>
+<script>
+  function sendToStreamlit(type, data) {
+    window.parent.postMessage(Object.assign({isStreamlitMessage: true, type: type}, data), '*');
+  }
+  window.addEventListener('message', function (event) {
+    if (event.data.type !== 'streamlit:render') return;
+    var frame = document.getElementById('map');
+    var src = 'maps/' + event.data.args.map;
+    if (frame.getAttribute('src') !== src) frame.setAttribute('src', src);
+  });
+  sendToStreamlit('streamlit:componentReady', {apiVersion: 1});
+  sendToStreamlit('streamlit:setFrameHeight', {height: %(height)d});
+</script>
+</body></html>
+"""
+
+
+@st.cache_data(ttl=MAP_TTL, max_entries=MAP_CACHE_ENTRIES, show_spinner=False, hash_funcs=GEOMETRY_HASH_FUNCS)
+def render_map_html(aoi: ee.Geometry, layers: tuple, sy: int, ey: int, vis_params: dict) -> str:
+    m = geemap.Map(center=[12.922,77.633],zoom=15,google_map='HYBRID')
+    display_layers(m,build_mean_image(aoi,sy,ey),list(layers),vis_params,aoi)
+    m.add_layer_control()  # render() doesn't add it, unlike to_streamlit()
+    return m.get_root().render()
+
+
+@st.cache_resource
+def get_map_component():
+    # one loader page and one registered component per process
+    os.makedirs(os.path.join(MAP_DIR,'maps'),exist_ok=True)
+    with open(os.path.join(MAP_DIR,'index.html'),'w',encoding='utf-8') as f:
+        f.write(MAP_LOADER_HTML % {'height': MAP_HEIGHT})
+    return components.declare_component('lake_map',path=MAP_DIR)
+
+
+def save_map(html: str) -> str:
+    # write under MAP_DIR/maps (rewritten if pruned), keep only the newest MAP_CACHE_ENTRIES files
+    maps_dir = os.path.join(MAP_DIR,'maps')
+    name = hashlib.blake2b(html.encode('utf-8'),digest_size=8).hexdigest()+'.html'
+    path = os.path.join(maps_dir,name)
+    try:
+        os.utime(path)
+        return name
+    except FileNotFoundError:
+        pass
+    with open(path,'w',encoding='utf-8') as f:
+        f.write(html)
+    try:
+        paths = sorted((os.path.join(maps_dir,n) for n in os.listdir(maps_dir)),key=os.path.getmtime,reverse=True)
+        for old in paths[MAP_CACHE_ENTRIES:]:
+            os.remove(old)
+    except OSError:
+        pass  # concurrent prune from another session
+    return name
+
+
+def show_map(html: str):
+    # served by Streamlit's component file handler, not pushed over the websocket
+    get_map_component()(map=save_map(html),key='lake_map',default=None)
 
 
 def describe_legends(vis_params,thresholds):
@@ -145,38 +319,74 @@ def describe_legends(vis_params,thresholds):
         st.markdown(f"**{k}**: Range [{p['min']},{p['max']}], Colors: {'→'.join(p['palette'])}, Alert > {thresholds[k]}")
 
 
-def render_sidebar_metrics(selected, mean_img, aoi, thresholds):
+def render_sidebar_metrics(selected, vals, thresholds):
     st.sidebar.markdown('## 🧪 Water Quality Summary')
-    alerts=[]
+    alerts,missing=[],[]
     for k in selected:
-        v=compute_mean_value(mean_img,k,aoi)
+        if vals.get(k) is None:
+            missing.append(k)
+            continue
+        v=float(vals[k])
         st.sidebar.markdown(f'- **{k} Mean:** {v:.3f}')
         if v>thresholds[k]: alerts.append(k)
+    if missing: st.sidebar.warning('No cloud-free imagery for '+','.join(missing)+'; try a wider or later year range.')
     if alerts: st.sidebar.error('⚠️ Alert:'+','.join(alerts)+' above safe levels!')
-    else: st.sidebar.success('✅ All metrics within safe limits')
+    elif not missing: st.sidebar.success('✅ All metrics within safe limits')
 
 # ------------------------
 # 7. MAIN
 # ------------------------
 def main():
     st.title('🌊 LakeHealth Dashboard')
-    init_earth_engine('lake-dashboard-464415')
-    appid = st.sidebar.text_input('API Key','',type='password')
-    sy = st.sidebar.slider('Start Year',2016,2024,2020)
-    ey = st.sidebar.slider('End Year',sy,2024,2024)
-    aoi = get_custom_geometry(appid)
-    st.sidebar.markdown('## Select Layers')
     layers=['FAI','MCI','Turbidity']
-    selected=[l for l in layers if st.sidebar.checkbox(l,True)]
-    col=load_sentinel_collection(aoi,sy,ey)
-    mean_img=compute_mean_image(col.map(add_fai_mci_turbidity))
+    # outside the form: it only drives the (cached) polygon list for the AOI picker
+    appid = st.sidebar.text_input('API Key','',type='password')
+    # widgets only take effect on Update, avoiding a rerun of the EE pipeline per change
+    with st.sidebar.form('controls'):
+        # range slider keeps sy <= ey inside the form
+        sy, ey = st.slider('Years',2016,2024,(2020,2024))
+        st.markdown('## Select Layers')
+        selected=[l for l in layers if st.checkbox(l,True)]
+        submitted = st.form_submit_button('Update')
+    if sy<FIRST_SR_YEAR:
+        st.sidebar.info(f'Surface-reflectance imagery starts in late {FIRST_SR_YEAR-1}; earlier years add no scenes.')
+    # EE init and the polygon list are independent network calls: run them concurrently
+    ctx = get_script_run_ctx()
+    with ThreadPoolExecutor(2, initializer=add_script_run_ctx, initargs=(None, ctx)) as ex:
+        f_ee = ex.submit(init_earth_engine, 'lake-dashboard-464415')
+        f_poly = ex.submit(list_polygons_api, appid) if appid else None
+        try:
+            f_ee.result()
+        except ee.EEException as e:
+            st.error(f'Earth Engine initialization failed: {e}')
+            st.stop()
+        polygons = None
+        if f_poly:
+            try:
+                polygons = f_poly.result()
+            except requests.RequestException as e:
+                st.sidebar.error(f'Could not load saved polygons: {e}')
+    aoi = get_custom_geometry(polygons)
     thresh={'FAI':0.05,'MCI':0.02,'Turbidity':1.8}
-    render_sidebar_metrics(selected,mean_img,aoi,thresh)
     vis={'FAI':{'min':-0.1,'max':0.1,'palette':['white','green','blue']},
          'MCI':{'min':-0.05,'max':0.2,'palette':['white','orange','red']},
          'Turbidity':{'min':0.0,'max':3.0,'palette':['blue','yellow','red']}}
-    display_layers(geemap.Map(center=[12.922,77.633],zoom=15,google_map='HYBRID'),
-                   mean_img,selected,vis,aoi)
+    if submitted or 'results' not in st.session_state:
+        # all thresholded bands in one request; layer toggles then hit the cache
+        st.session_state['results'] = {'selected':selected,'aoi_hash':_geom_hash(aoi),
+                                       'vals':get_mean_values(aoi,sy,ey,tuple(thresh)),
+                                       'map_args':(aoi,tuple(selected),sy,ey),
+                                       'map_html':render_map_html(aoi,tuple(selected),sy,ey,vis),
+                                       'rendered_at':time.time()}
+    res = st.session_state['results']
+    # long-open tab: re-render so the embedded tile URLs stay valid
+    if time.time()-res['rendered_at']>MAP_TTL:
+        res['map_html'] = render_map_html(*res['map_args'],vis)
+        res['rendered_at'] = time.time()
+    if res['aoi_hash']!=_geom_hash(aoi):
+        st.info('AOI changed — press Update to refresh the map and metrics.')
+    render_sidebar_metrics(res['selected'],res['vals'],thresh)
+    show_map(res['map_html'])
     describe_legends(vis,thresh)
 
 if __name__=='__main__':